@@ -1,16 +1,7 @@
 import hashlib
-import logging
-import time
+from concurrent.futures import ThreadPoolExecutor
 
-clock = time.time()
-
-
-def check_time():
-    logging.debug("{}s since last clock reset")
-
-
-def start_stopwatch():
-    logging.debug("Starting timing...")
+HASH_CHUNK_SIZE = 1 << 16
 
 
 def get_file_md5_hash(filename: str) -> bytes:
@@ -19,9 +10,12 @@ def get_file_md5_hash(filename: str) -> bytes:
     :param filename: Name of the file to be hashed
     :return: A bytes object, which the is the digest of the MD5 of the file
     """
-    with open(filename, "r") as file:
-        data = file.read()
-        return hashlib.md5(data).digest()
+    # Hash the file in fixed size chunks so memory use doesn't grow with the file
+    md5 = hashlib.md5()
+    with open(filename, "rb") as file:
+        for chunk in iter(lambda: file.read(HASH_CHUNK_SIZE), b""):
+            md5.update(chunk)
+    return md5.digest()
 
 
 def confirm_files_equal(filename_one: str, filename_two: str) -> bool:
@@ -31,6 +25,7 @@ def confirm_files_equal(filename_one: str, filename_two: str) -> bool:
     :param filename_two: Name of the second file
     :return: True if the files have the same MD5 hash, else False
     """
-    a = get_file_md5_hash(filename_one)
-    b = get_file_md5_hash(filename_two)
+    # hashlib releases the GIL while it hashes each chunk, so the two files can be hashed side by side
+    with ThreadPoolExecutor(2) as executor:
+        a, b = executor.map(get_file_md5_hash, [filename_one, filename_two])
     return True if a == b else False
@@ -1,47 +1,79 @@
 """Implements Huffman Encoding and Decoding for any UNICODE encoded string"""
 import os
 import time
+import heapq
+import json
 import logging
+import mmap
+from array import array
+from collections import Counter
 from datetime import datetime
 import bitarray
 
 logging.basicConfig(level=logging.DEBUG)
+logger = logging.getLogger(__name__)
 clock = 0
+# Strings with at most this many distinct characters are counted with str.count rather than Counter
+SMALL_ALPHABET_SIZE = 16
+# How many characters from the start of the string are checked before trying str.count
+ALPHABET_SAMPLE_SIZE = 1 << 16
+# How many characters are translated at a time when every code is a single bit
+ENCODE_CHUNK_SIZE = 1 << 16
+# Encoding dicts that have already been generated, keyed by the frozenset of the frequency map they came from
+schema_cache = {}
 
 
-class Node:
-    def __init__(self, value, char=None, left=None, right=None):
-        self.value = value
-        self.char = char
-        self.left = left
-        self.right = right
+class Tree:
+    """
+    A Huffman tree stored as parallel arrays indexed by node id, rather than as linked node objects.
+    A node with no children (left == -1) is a leaf, and char holds the codepoint of its character
+    """
+    def __init__(self):
+        self.left = array("i")
+        self.right = array("i")
+        self.char = array("i")
+        self.root = -1
         return
 
     def __repr__(self):
-        return "Node({}, {})".format(
-            self.value,
-            self.char
+        return "Tree({} nodes, root {})".format(
+            len(self.left),
+            self.root
             )
 
-    def get_schema(self, pattern: str = "") -> dict:
+    def add_node(self, char: str = None, left: int = -1, right: int = -1) -> int:
+        """
+        Adds a node to the tree
+        :param char: The character of a leaf node, None for a parent node
+        :param left: The id of the left child
+        :param right: The id of the right child
+        :return: The id of the new node
+        """
+        self.left.append(left)
+        self.right.append(right)
+        self.char.append(-1 if char is None else ord(char))
+        return len(self.left) - 1
+
+    def get_schema(self) -> dict:
         """
         Returns a dictionary mapping characters to a binary string, which is used to Huffman encode them
-        :param pattern: Should NOT be parsed - used for recursion
         :return: The encoding dictionary
         """
-        left, right = self.left, self.right
-
-        # If this is an end node, return da schema table
-        if self.char is not None:
-            return {self.char: pattern}
-
-        # Otherwise, recursion time. Append to the pattern :)
-        left_schema = left.get_schema(
-            pattern="{}0".format(pattern))
-        right_schema = right.get_schema(
-            pattern="{}1".format(pattern))
-        
-        return left_schema | right_schema
+        schema = {}
+        left, right, char = self.left, self.right, self.char
+        # Walk the tree with a stack of (node id, depth, code so far). The code is kept as an int and only
+        # formatted into a string once we reach a leaf
+        stack = [(self.root, 0, 0)]
+        while stack:
+            node, depth, code = stack.pop()
+            if left[node] == -1:
+                # A root with no children still needs a code that's at least 1 bit long
+                schema[chr(char[node])] = format(code, "0{}b".format(max(depth, 1)))
+            else:
+                stack.append((right[node], depth + 1, code << 1 | 1))
+                stack.append((left[node], depth + 1, code << 1))
+
+        return schema
 
 
 def generate_frequency_map(string: str) -> dict:
@@ -50,73 +82,79 @@ def generate_frequency_map(string: str) -> dict:
     :return: The frequency map
     """
     print("Generating frequency map...")
-    char_map = {}
-    for char in string:
-        if char in char_map.keys():
-            char_map[char] += 1
-        else:
-            char_map[char] = 1
+    char_map = None
+    # str.count is a fast C search, so for a small alphabet one pass per character beats hashing every character
+    # through Counter. Checking a sample first means large alphabets don't pay for the extra set() pass
+    if len(set(string[:ALPHABET_SAMPLE_SIZE])) <= SMALL_ALPHABET_SIZE:
+        alphabet = set(string)
+        if len(alphabet) <= SMALL_ALPHABET_SIZE:
+            # Sorted so the map (and so the tree) comes out the same on every run
+            char_map = {char: string.count(char) for char in sorted(alphabet)}
+    if char_map is None:
+        char_map = dict(Counter(string))
     print("Done.")
     stopwatch()
     return char_map
 
 
-def construct_tree(char_map: dict) -> Node:
+def construct_tree(char_map: dict) -> Tree:
     """
     Generates a Huffman tree from a frequency map
     :param char_map: The frequency map for the string the tree will be generated for
-    :return: The top node of the Huffman tree
+    :return: The Huffman tree
     """
-    ascending_keys = [Node(char_map[k], k) for k in char_map.keys()]
-    while len(ascending_keys) > 1:
-        # Re-sort the list as it the 'value' of a node changes when children are added
-        ascending_keys.sort(key=lambda x: x.value)
-        # Pop the first two elements
-        left = ascending_keys.pop(0)
-        right = ascending_keys.pop(0)
+    tree = Tree()
+    # Heap entries are (value, node id) - node ids are unique, so they double up as the tiebreak
+    heap = [(v, tree.add_node(k)) for k, v in char_map.items()]
+    heapq.heapify(heap)
+    while len(heap) > 1:
+        # Pop the two least frequent nodes
+        left_value, left = heapq.heappop(heap)
+        right_value, right = heapq.heappop(heap)
         # Generate a new parent node
-        new_parent_node = Node(
-            left.value + right.value,
-            None,
-            left,
-            right
-            )
-        
-        ascending_keys.append(new_parent_node)
-    
-    return ascending_keys[0]
+        heapq.heappush(heap, (left_value + right_value, tree.add_node(None, left, right)))
+
+    tree.root = heap[0][1]
+    return tree
 
 
-def encode_string_with_schema(string: str, encoding: dict) -> str:
+def encode_string_with_schema(string: str, encoding: dict) -> bitarray.bitarray:
     """
     Encodes a string using a dictionary mapping generated from a Huffman tree
     :param string: The string to be encoded
     :param encoding: The dictionary mapping
-    :return: An encoded string of 1s and 0s
+    :return: A bitarray of the encoded string
     """
-    output = []
-    for char in string:
-        output.append(encoding[char])
-    return "".join(output)
-
-
-def decode_string_with_schema(string: str, encoding: dict) -> str:
+    bits = bitarray.bitarray()
+    if all(len(code) == 1 for code in encoding.values()):
+        # With an alphabet of two every code is a single bit, so each character can be translated straight to a "0"
+        # or "1". str.translate has a fast path for one character to one character tables which is several times
+        # quicker than bitarray.encode. Going a chunk at a time keeps the intermediate string small
+        table = str.maketrans(encoding)
+        for i in range(0, len(string), ENCODE_CHUNK_SIZE):
+            bits.extend(string[i:i + ENCODE_CHUNK_SIZE].translate(table))
+        return bits
+
+    # bitarray.encode walks the string in C and appends each code straight into the output bits
+    codes = {k: bitarray.bitarray(v) for k, v in encoding.items()}
+    bits.encode(codes, string)
+    return bits
+
+
+def decode_string_with_schema(bits: bitarray.bitarray, encoding: dict) -> str:
     """
     Decodes a string using a dictionary mapping generated from a Huffman tree
-    :param string: The string to be decoded
+    :param bits: The encoded bits to be decoded
     :param encoding: The dictionary mapping
     :return: A decoded string
     """
-    # Swap the encoding dictionary
-    encoding = dict((v, k) for k, v in encoding.items())
-    output = ""
-    pattern = ""
-    for char in string:
-        pattern += char
-        if pattern in encoding:
-            output += encoding[pattern]
-            pattern = ""
-    return output
+    # An empty string has an empty encoding, and decodetree needs at least one code
+    if not encoding:
+        return ""
+    # decodetree compiles the codes into a prefix tree in C, which decode then walks natively one bit at a time,
+    # rather than growing a pattern string bit by bit
+    tree = bitarray.decodetree({k: bitarray.bitarray(v) for k, v in encoding.items()})
+    return "".join(bits.decode(tree))
 
 
 # Returns the encoding and the string
@@ -124,43 +162,52 @@ def huffman_encode(string: str) -> tuple:
     """
     Returns an encoding and an encoded string for the given string
     :param string: The string to encode
-    :return: The encoding dictionary, the encoded string, the frequency map of the original string
+    :return: The encoding dictionary, the encoded bits, the frequency map of the original string
     """
     freq_map = generate_frequency_map(string)
-    print("Generating tree...")
-    top_node = construct_tree(freq_map)
-    print("Done.")
-    stopwatch()
-    print("Generating encoding dict...")
-    encoding = top_node.get_schema()  # Recursively generates a dict from the tree
-    print("Done.")
-    stopwatch()
+    cache_key = frozenset(freq_map.items())
+    if cache_key in schema_cache:
+        print("Reusing encoding dict...")
+        encoding = schema_cache[cache_key]
+    elif len(freq_map) <= 1:
+        # With only one character there is nothing to tell it apart from, so skip the tree and give it a 1 bit code
+        encoding = {char: "0" for char in freq_map}
+    else:
+        print("Generating tree...")
+        tree = construct_tree(freq_map)
+        print("Done.")
+        stopwatch()
+        print("Generating encoding dict...")
+        encoding = tree.get_schema()  # Walks the tree to generate a dict
+        print("Done.")
+        stopwatch()
+        schema_cache[cache_key] = encoding
     print("Encoding string...")
-    encoded_string = encode_string_with_schema(string, encoding)
+    encoded_bits = encode_string_with_schema(string, encoding)
     print("Done.")
     stopwatch()
-    return encoding, encoded_string, freq_map
+    return encoding, encoded_bits, freq_map
 
 
-def save_to_file(string: str, character_map: dict, file_name: str) -> None:
+def save_to_file(bits: bitarray.bitarray, encoding: dict, file_name: str) -> None:
     """
     Serialises an encoded string and scheme to a file
-    :param string: The encoded binary string to be saved to a file
-    :param character_map: The frequency map of the *original* string
+    :param bits: The encoded bits to be saved to a file
+    :param encoding: The dictionary mapping used to encode the bits
     :param file_name: The name of the original file
     """
 
-    # Append a null byte as an "end of frequency map" marker
-    character_map = repr(character_map)
-    bits = bitarray.bitarray("00000000")
-    bits.extend(string)
+    # Storing the encoding itself means decompression doesn't have to rebuild the tree.
+    # The padding is needed because tobytes() rounds up to a whole byte, and those extra bits could decode as characters
+    # json.dumps escapes everything outside of ASCII, so the header can never contain our null marker
+    header = json.dumps({"padding": (8 - len(bits) % 8) % 8, "encoding": encoding})
 
-    # Create the file
-    open("{}.huff".format(file_name), "w").close()
-    # Write to it
-    with open("{}.huff".format(file_name), "r+b") as file:
-        file.write(character_map.encode("utf-8"))  # Store the frequency map so a tree can be reconstructed later
-        bits.tofile(file)
+    # A null byte goes between the header and the bits as an "end of header" marker.
+    # Everything is joined into one buffer first so the file is written in a single call
+    data = b"".join((header.encode("utf-8"), b"\x00", bits.tobytes()))
+    # "wb" creates or truncates the file, so it only needs opening once
+    with open("{}.huff".format(file_name), "wb") as file:
+        file.write(data)
 
 
 # TODO: Split this function up, too much is going on
@@ -180,55 +227,58 @@ def decompress_from_file(file_name: str) -> None:
         if not input("> ").lower() == "y":
             return
 
-    freq_map = None
-    bits = bitarray.bitarray()
     with open(file_name, "rb") as compressed_file:
-        # Load the binary data into a bitarray object
-        bits.fromfile(compressed_file)
-        # Loop through bytes until we find our null marker, and then everything before that is the frequency map
-        null_marker = bitarray.bitarray("00000000")
-        # We're looking for a null byte, so we loop through 8 bits at a time
-        byte_count = int(len(bits)/8)
-        for i in range(byte_count):
-            bit_slice = bits[i*8: i*8 + 8]
-            if bit_slice == null_marker:  # We've reached the end of the header
-                freq_map = bits[0:i*8]  # Grab the frequency map
-                bits = bits[i*8 + 8:]  # Trim the header from the file
-                break
-
-        if freq_map is None:
-            raise ValueError("File header is corrupted or non-existent")
-
-        freq_map_string = freq_map.tobytes().decode("utf-8")
-        freq_map = eval(freq_map_string)
-    # Convert bitarray to a string of 1s and 0s. In retrospect this probably should have all been done in lists
-    encoded_string = "".join(map(lambda x: "1" if x else "0", bits.tolist()))
-    # Construct the tree, generate the encoding, and decompress the string
-    top_node = construct_tree(freq_map)
-    encoding = top_node.get_schema()
-    original_text = decode_string_with_schema(encoded_string, encoding)
+        data = compressed_file.read()
+    # Everything before the first null byte is the header
+    header_end = data.find(b"\x00")
+    if header_end == -1:
+        raise ValueError("File header is corrupted or non-existent")
+
+    # The header is plain JSON, so nothing in the file ever gets run as code - but it still has to be checked
+    # that it's the shape we expect before we trust it
+    try:
+        header = json.loads(data[:header_end].decode("utf-8"))
+        encoding = header["encoding"]
+        padding = header["padding"]
+    except (ValueError, KeyError, TypeError):
+        raise ValueError("File header is corrupted or non-existent")
+    if not isinstance(encoding, dict) or not isinstance(padding, int) or not 0 <= padding < 8:
+        raise ValueError("File header is corrupted or non-existent")
+
+    # Load the rest of the file into a bitarray object. Slicing a memoryview rather than the bytes themselves means
+    # the payload is only copied once, straight into the bitarray
+    bits = bitarray.bitarray()
+    bits.frombytes(memoryview(data)[header_end + 1:])
+    # Trim the bits tobytes() padded the last byte with
+    if padding:
+        del bits[-padding:]
+    # Decompress the string
+    original_text = decode_string_with_schema(bits, encoding)
     # Save the uncompressed file
-    with open(file_name.removesuffix(".huff"), "w") as file:
+    # newline="" so the text is written back byte for byte, the same as it was read in
+    with open(file_name.removesuffix(".huff"), "w", encoding="utf-8", newline="") as file:
         file.write(original_text)
 
 
 # TODO: Update for a verbose mode
 def stopwatch():
-    t = time.time()
-    logging.debug("{}ms since program start".format(t - clock))
+    # Only read the clock and format the message if it's actually going to be logged
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("%dms since program start", (time.perf_counter_ns() - clock) // 1_000_000)
 
 
 print("Started at {}".format(datetime.now()))
-clock = time.time()
+clock = time.perf_counter_ns()
 
 test_file = "fib41"
-with open(test_file) as file:
+# Map the file rather than read() it, so the data is copied straight out of the page cache
+with open(test_file, "rb") as file, mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mapped_file:
     print("Reading file...")
-    data = file.read()
+    data = mapped_file.read().decode("utf-8")
     stopwatch()
-    e, s, m = huffman_encode(data)
-    print("Saving to file...")
-    save_to_file(s, m, test_file)
+e, s, m = huffman_encode(data)
+print("Saving to file...")
+save_to_file(s, e, test_file)
 
 print("Finished at {}".format(datetime.now()))
 stopwatch()
@@ -242,7 +292,7 @@ print("Compression ratio: {}\ni.e. file size multiplied by {}".format(
 ))
 
 print("Decompressing the file back!")
-clock = time.time()
+clock = time.perf_counter_ns()
 decompress_from_file("{}.huff".format(test_file))
 print("Done")
 stopwatch()